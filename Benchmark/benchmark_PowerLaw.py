@@ -1,6 +1,7 @@
 import numpy as np
 import sys
 import os
+import hashlib
 
 
 import dustpy
@@ -166,33 +167,197 @@ def get_Simulation(build_up = False, SigmaDust = None, fix_boundaries = False):
     sim.update()
     return sim
 
+################################
+# STEADY STATE MONITOR
+################################
+'''
+The gas and dust surface densities are compared with the power-law steady-state solution (the initial condition),
+over the interior cells, every steady_settings["interval"] of simulation time.
+Each check records the relative residual (maximum of |Sigma - Sigma_0| / Sigma_0) and its rate of change since the previous check.
+
+The run stops early once the residual, extrapolated with the largest rate of the last checks until the last snapshot,
+stays below the tolerance: the benchmark has then passed, and integrating further would not change the result.
+Otherwise the run continues until the last snapshot, and it passes if the final residual is below the tolerance.
+The convergence history and the stop time are saved into steady_state.npz in the datadir.
+The state at the early stop (not at a snapshot time) is written into steady_state.hdf5, and the data files
+of the snapshots after it (left from previous runs) are removed, so that the data files only hold this run.
+'''
+steady_settings = {
+    "margin": 5,                    # Boundary cells excluded at each side
+    "interval": 1.e3 * c.year,      # Simulation time between checks
+    "tolerance": 1.e-3,             # Maximum relative residual to pass
+    "window": 5,                    # Number of checks for the rate of change
+}
+
+class SteadyState_Reached(Exception):
+    '''
+    Raised by the monitor to stop the run, once the residual stays below the tolerance until the last snapshot.
+    '''
+    pass
+
+def steady_Install(sim, settings = steady_settings):
+    '''
+    Stores the power-law solution (the current gas and total dust surface densities),
+    and sets the monitor as the diastole of the simulation updater, called after every integration step.
+    '''
+    interior = slice(settings["margin"], -settings["margin"])
+    reference = np.array([sim.gas.Sigma[interior], sim.dust.Sigma[interior].sum(-1)])
+    sim._steady = {"settings": settings, "interior": interior, "reference": reference,
+                   "last": reference.copy(), "t_last": float(sim.t), "history": [], "passed": False}
+    sim._steady["history"].append([float(sim.t), 0., 0., 0., 0.])
+    sim.updater.diastole = steady_Monitor
+
+def steady_Monitor(sim):
+    '''
+    Residual of the gas and dust surface densities against the power-law solution, and its rate of change [1/s].
+    Raises SteadyState_Reached when the extrapolated residual stays below the tolerance until the last snapshot.
+    '''
+    steady = sim._steady
+    settings = steady["settings"]
+    t = float(sim.t)
+    if t - steady["t_last"] < settings["interval"]:
+        return
+
+    # Gas and total dust surface densities, (2, Nr) over the interior cells
+    current = np.array([sim.gas.Sigma[steady["interior"]], sim.dust.Sigma[steady["interior"]].sum(-1)])
+    residual = np.max(np.abs(current - steady["reference"]) / steady["reference"], axis = 1)
+    rate = np.max(np.abs(current - steady["last"]) / steady["reference"], axis = 1) / (t - steady["t_last"])
+    steady["history"].append([t, residual[0], residual[1], rate[0], rate[1]])
+    steady["last"] = current
+    steady["t_last"] = t
+
+    # Wait for enough checks to estimate the rate of change
+    history = np.array(steady["history"][-settings["window"]:])
+    if len(steady["history"]) <= settings["window"]:
+        return
+
+    remaining = sim.t.snapshots[-1] - t
+    projected = history[-1, 1:3] + np.max(history[:, 3:5], axis = 0) * remaining
+    if np.max(projected) < settings["tolerance"]:
+        steady["passed"] = True
+        raise SteadyState_Reached()
+
+def steady_Run(sim):
+    '''
+    Runs the simulation until the last snapshot, or until the steady state is reached.
+    In the latter case, the current state is written into steady_state.hdf5, and the later snapshot files are removed.
+    Saves the convergence history into the datadir, and returns whether the benchmark passed.
+    '''
+    steady = sim._steady
+    try:
+        sim.run()
+    except SteadyState_Reached:
+        # The outputs written in this run are those of the snapshots before the current time (0 to index - 1)
+        index = int(np.argmax(sim.t < sim.t.snapshots))
+        sim.writer.write(sim, index, True, filename = os.path.join(sim.writer.datadir, "steady_state.hdf5"))
+        for i in range(index, len(sim.t.snapshots)):
+            filename = os.path.join(sim.writer.datadir, "{}{}.{}".format(sim.writer.filename, str(i).zfill(sim.writer.zfill),
+                                                                         sim.writer.extension))
+            if os.path.isfile(filename):
+                os.remove(filename)
+        print("Steady state reached at t = {:.3g} yr".format(sim.t / c.year))
+    else:
+        steady["passed"] = max(steady["history"][-1][1:3]) < steady["settings"]["tolerance"]
+
+    history = np.array(steady["history"])
+    os.makedirs(sim.writer.datadir, exist_ok = True)
+    np.savez(os.path.join(sim.writer.datadir, "steady_state.npz"), t = history[:, 0],
+             residual_gas = history[:, 1], residual_dust = history[:, 2], rate_gas = history[:, 3], rate_dust = history[:, 4],
+             tolerance = steady["settings"]["tolerance"], passed = steady["passed"], t_stop = float(sim.t))
+    print("Steady state benchmark {}: residual gas {:.3g}, dust {:.3g} (tolerance {:.3g})".format(
+        "passed" if steady["passed"] else "failed", history[-1, 1], history[-1, 2], steady["settings"]["tolerance"]))
+    return steady["passed"]
+
+################################
+# BUILD-UP CHECKPOINTS
+################################
+'''
+The build-up result is stored in a checkpoint cache, under a hash of the grid, the disk parameters and the snapshots.
+Later runs with the same parameters load it instead of integrating the build-up again.
+The oldest (least recently used) checkpoints are deleted when the cache exceeds checkpoint_max_size.
+'''
+checkpoint_dir = "./Checkpoints_BuildUp/"
+checkpoint_max_size = 256 * 1024**2  # Bytes
+
+def checkpoint_Key(sim, snapshots):
+    '''
+    Hash of the initial state of the build-up simulation (grid, disk and dust parameters) and its snapshots.
+    '''
+    key = hashlib.sha1(dustpy.__version__.encode())
+    for value in [sim.grid.r, sim.grid.m, sim.star.M, sim.gas.Sigma, sim.gas.cs, sim.gas.alpha, sim.dust.Sigma, sim.dust.rhos,
+                  sim.dust.delta.rad, sim.dust.delta.turb, sim.dust.delta.vert, sim.dust.v.frag, snapshots]:
+        key.update(np.ascontiguousarray(value, dtype = float).tobytes())
+    return key.hexdigest()
+
+def checkpoint_Load(key):
+    '''
+    Returns the stored build-up state (dictionary with the gas and dust surface densities and the time), or None if not cached.
+    '''
+    filename = os.path.join(checkpoint_dir, key + ".npz")
+    if not os.path.isfile(filename):
+        return None
+    os.utime(filename)  # Mark as recently used
+    with np.load(filename) as data:
+        return {name: data[name] for name in data.files}
+
+def checkpoint_Store(key, sim):
+    '''
+    Stores the build-up state, and deletes the least recently used checkpoints beyond checkpoint_max_size.
+    '''
+    os.makedirs(checkpoint_dir, exist_ok = True)
+    filename = os.path.join(checkpoint_dir, key + ".npz")
+    np.savez(filename + ".tmp.npz", SigmaGas = sim.gas.Sigma, SigmaDust = sim.dust.Sigma, t = sim.t)
+    os.replace(filename + ".tmp.npz", filename)
+
+    checkpoints = [os.path.join(checkpoint_dir, name) for name in os.listdir(checkpoint_dir) if name.endswith(".npz")]
+    checkpoints.sort(key = os.path.getmtime, reverse = True)
+    size = 0
+    for checkpoint in checkpoints:
+        size += os.path.getsize(checkpoint)
+        if size > checkpoint_max_size and checkpoint != filename:
+            os.remove(checkpoint)
+
+def get_BuildUp(snapshots):
+    '''
+    Dust surface density after the build-up, loaded from the checkpoint cache or integrated (and then cached).
+    '''
+    sim_build_up = get_Simulation(build_up = True)
+    key = checkpoint_Key(sim_build_up, snapshots)
+
+    checkpoint = checkpoint_Load(key)
+    if checkpoint is not None:
+        print("Build-up loaded from checkpoint {}".format(key))
+        return checkpoint["SigmaDust"]
+
+    sim_build_up.writer.datadir = "./Simulation_BuildUp/"
+    sim_build_up.t.snapshots = snapshots
+    sim_build_up.writer.overwrite = True
+    sim_build_up.run()
+    checkpoint_Store(key, sim_build_up)
+    return np.array(sim_build_up.dust.Sigma)
+
 ################################
 # RUN SIMULATION
 ################################
 
-# Make the build-up simulation to get the dust distribution
-sim_build_up = get_Simulation(build_up = True)
-sim_build_up.writer.datadir = "./Simulation_BuildUp/"
-sim_build_up.t.snapshots = np.linspace(1., 5., 5) * 1.e4 * c.year
-sim_build_up.writer.overwrite = True
-sim_build_up.run()
+# Make the build-up simulation to get the dust distribution (or load it from the checkpoint cache)
+SigmaDust_BuildUp = get_BuildUp(np.linspace(1., 5., 5) * 1.e4 * c.year)
 
 
 
 
 # Let the simulation evolve normally with gas and dust advection, starting from the fully grown dust distribution
-sim = get_Simulation(build_up = False, SigmaDust = sim_build_up.dust.Sigma)
+# The runs stop early once they remain in the steady state (see the steady state monitor)
+sim = get_Simulation(build_up = False, SigmaDust = SigmaDust_BuildUp)
 sim.writer.datadir = "./Simulation_PowerLaw/"
 sim.t.snapshots = np.linspace(0.1, 1.5, 15) * 1.e5 * c.year
 sim.writer.overwrite = True
-sim.run()
-
-
-#hdf5writer.datadir = "./Simulation_BuildUp/"
-#sim_build_up = hdf5writer.read.output(5)
+steady_Install(sim)
+steady_Run(sim)
 
-sim = get_Simulation(build_up = False, SigmaDust = sim_build_up.dust.Sigma, fix_boundaries = True)
+sim = get_Simulation(build_up = False, SigmaDust = SigmaDust_BuildUp, fix_boundaries = True)
 sim.writer.datadir = "./Simulation_PowerLaw_FixBoundaries/"
 sim.t.snapshots = np.linspace(0.1, 1.5, 15) * 1.e5 * c.year
 sim.writer.overwrite = True
-sim.run()
+steady_Install(sim)
+steady_Run(sim)
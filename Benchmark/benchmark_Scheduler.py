@@ -0,0 +1,109 @@
+import numpy as np
+import sys
+import time
+
+
+from dustpy import Simulation
+from dustpy import constants as c
+from simframe.frame import Field, Group
+
+sys.path.append("../")
+from setup_backreaction import setup_backreaction
+from scheduler_backreaction import Scheduler_Stats
+
+
+################################
+# BENCHMARK
+################################
+'''
+Check of the update scheduler (setup_backreaction(scheduler = True)).
+A short run is done with and without the scheduler, and every field of the simulation must be identical at the end,
+including the boundary values of the fluxes and sources written by the implicit finalizer.
+The runs are repeated for the simple and vertical setups, with and without a systole that fixes the boundaries
+(as systole_FixBoundaries in benchmark_PowerLaw.py), and with and without velocity_update.
+The number of eliminated updates is reported, with those of gas.v.visc (once per step with velocity_update).
+
+Usage: python benchmark_Scheduler.py
+'''
+
+t_end = 100. * c.year
+
+
+def get_Simulation(vertical_setup, fix_boundaries, velocity_update, scheduler):
+    sim = Simulation()
+
+    sim.ini.gas.alpha = 1.e-3
+    sim.ini.dust.d2gRatio = 0.05
+
+    sim.ini.grid.Nr = 40
+    sim.ini.grid.rmin = 5 * c.au
+    sim.ini.grid.rmax = 500 * c.au
+
+    sim.initialize()
+
+    SigmaGas = np.array(sim.gas.Sigma)
+    SigmaDust = np.array(sim.dust.Sigma)
+
+    def systole_FixBoundaries(sim):
+        sim.gas.Sigma[:2] = SigmaGas[:2]
+        sim.dust.Sigma[:2, :] = SigmaDust[:2, :]
+        sim.gas.Sigma[-2:] = SigmaGas[-2:]
+        sim.dust.Sigma[-2:, :] = SigmaDust[-2:, :]
+
+        sim.gas.v.update()
+        sim.gas.Fi.update()
+        sim.gas.S.hyd.update()
+
+        sim.dust.v.rad.update()
+        sim.dust.Fi.update()
+        sim.dust.S.hyd.update()
+        sim.dust.S.coag.update()
+
+    if fix_boundaries:
+        sim.updater.systole = systole_FixBoundaries
+
+    setup_backreaction(sim, vertical_setup = vertical_setup, velocity_update = velocity_update, scheduler = scheduler)
+    sim.writer = None
+    sim.verbosity = 0
+    sim.t.snapshots = [t_end]
+    return sim
+
+
+def get_Fields(group, prefix = ""):
+    '''
+    Dictionary with a copy of every field of the group and its subgroups, by path.
+    '''
+    fields = {}
+    for name, value in group.__dict__.items():
+        if name.startswith("_"):
+            continue
+        if isinstance(value, Field):
+            fields[prefix + name] = np.array(value)
+        elif isinstance(value, Group):
+            fields.update(get_Fields(value, prefix + name + "."))
+    return fields
+
+
+identical = True
+print("{:>9s} {:>15s} {:>9s} {:>10s} {:>10s} {:>10s} {:>11s} {:>11s} {:>6s}".format("vertical", "fix_boundaries", "velocity",
+      "time off", "time on", "identical", "eliminated", "gas.v.visc", "steps"))
+for vertical_setup in [False, True]:
+    for fix_boundaries in [False, True]:
+        for velocity_update in [False, True]:
+            results = []
+            for scheduler in [False, True]:
+                sim = get_Simulation(vertical_setup, fix_boundaries, velocity_update, scheduler)
+                start = time.perf_counter()
+                sim.run()
+                results.append((time.perf_counter() - start, get_Fields(sim)))
+            different = [name for name, value in results[0][1].items() if not np.array_equal(value, results[1][1][name])]
+            identical &= not different
+            stats = Scheduler_Stats(sim)
+            print("{:>9s} {:>15s} {:>9s} {:10.2f} {:10.2f} {:>10s} {:11d} {:11d} {:6d}".format(str(vertical_setup), str(fix_boundaries),
+                  str(velocity_update), results[0][0], results[1][0], str(not different), stats["eliminated"],
+                  stats["eliminated_per_field"].get("gas.v.visc", 0), stats["steps"]))
+            if different:
+                print("    Different fields: {}".format(", ".join(different)))
+
+if not identical:
+    sys.exit(1)
@@ -0,0 +1,176 @@
+import numpy as np
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from types import SimpleNamespace
+
+
+from dustpy import constants as c
+
+sys.path.append("../")
+from functions_backreaction import default_settings
+from functions_backreaction import BackreactionCoefficients, BackreactionCoefficients_VerticalStructure
+from functions_backreaction import update_BackreactionVerticalStructure, vrad_dust_BackreactionVerticalStructure
+from functions_backreaction import dustDiffusivity_Backreaction
+
+
+################################
+# BENCHMARK
+################################
+'''
+Time per call and peak memory of the backreaction functions, over a matrix of grid sizes (Nr, Nm, Nz).
+The functions run on lightweight stand-in simulations (no dustpy Simulation is built), with a power-law disk.
+
+The results are saved as JSON. If a baseline (a previous results file) is given,
+the benchmark fails when a function is slower or uses more memory than the baseline beyond the thresholds.
+
+Usage: python benchmark_kernels.py [--output results.json] [--baseline baseline.json] [--threshold 0.25]
+'''
+
+# Grid sizes. Nz only applies to the vertical integration
+Nr_list = [100, 250]
+Nm_list = [60, 120]
+Nz_list = {"trapz": [300], "quadrature": [32]}
+
+# Reduced precision modes of the vertical integration (float64 is always included)
+precision_list = ["float32", "mixed"]
+
+
+def get_StandIn(Nr, Nm, settings = None):
+    '''
+    Stand-in simulation with the fields read by the backreaction functions.
+    Power-law gas disk, with an MRN-like dust distribution between St = 1e-5 and St = 1.
+    '''
+    alpha = 1.e-3
+    r = np.logspace(0, 2, Nr) * 5 * c.au
+    OmegaK = np.sqrt(c.G * c.M_sun / r**3)
+    cs = 0.05 * r * OmegaK
+    Hp = cs / OmegaK
+
+    Sigma_g = 1000. * (r / c.au)**-1
+    rho_g = Sigma_g / (np.sqrt(2 * np.pi) * Hp)
+
+    St = np.logspace(-5, 0, Nm)[None, :] * np.ones((Nr, 1))
+    Sigma_d = 0.01 * Sigma_g[:, None] * St**0.5 / np.sum(St**0.5, axis = 1)[:, None]
+    H_d = Hp[:, None] * np.sqrt(alpha / (alpha + St))
+    rho_d = Sigma_d / (np.sqrt(2 * np.pi) * H_d)
+
+    backreaction = SimpleNamespace(AB = np.empty((2, Nr)), A = np.empty(Nr), B = np.empty(Nr),
+                                   A_vertical = np.empty((Nr, Nm)), B_vertical = np.empty((Nr, Nm)))
+    if settings is not None:
+        backreaction._settings = settings
+
+    sim = SimpleNamespace(
+        grid = SimpleNamespace(Nr = np.array([Nr]), Nm = np.array([Nm]), r = r, OmegaK = OmegaK),
+        gas = SimpleNamespace(Sigma = Sigma_g, Hp = Hp, rho = rho_g, cs = cs, eta = (cs / (r * OmegaK))**2,
+                              v = SimpleNamespace(visc = -1.5 * alpha * cs**2 / (r * OmegaK))),
+        dust = SimpleNamespace(Sigma = Sigma_d, St = St, H = H_d, rho = rho_d,
+                               delta = SimpleNamespace(rad = alpha * np.ones(Nr)), backreaction = backreaction),
+    )
+    return sim
+
+
+def get_Cases():
+    '''
+    List of (name, function, Nr, Nm, Nz, settings) to benchmark.
+    '''
+    cases = []
+    for Nr in Nr_list:
+        for Nm in Nm_list:
+            cases.append(("BackreactionCoefficients", BackreactionCoefficients, Nr, Nm, None, None))
+            cases.append(("dustDiffusivity_Backreaction", dustDiffusivity_Backreaction, Nr, Nm, None, None))
+            cases.append(("vrad_dust_BackreactionVerticalStructure", vrad_dust_BackreactionVerticalStructure, Nr, Nm, None, None))
+            for integration, Nz_values in Nz_list.items():
+                for Nz in Nz_values:
+                    settings = dict(default_settings, integration = integration, Nz = Nz)
+                    name = "[{}]".format(integration)
+                    cases.append(("BackreactionCoefficients_VerticalStructure" + name, BackreactionCoefficients_VerticalStructure,
+                                  Nr, Nm, Nz, settings))
+                    cases.append(("update_BackreactionVerticalStructure" + name, update_BackreactionVerticalStructure,
+                                  Nr, Nm, Nz, settings))
+                    for precision in precision_list:
+                        name = "[{},{}]".format(integration, precision)
+                        cases.append(("update_BackreactionVerticalStructure" + name, update_BackreactionVerticalStructure,
+                                      Nr, Nm, Nz, dict(settings, precision = precision, precision_check = None)))
+    return cases
+
+
+def run_Case(function, sim, repeat, min_time = 0.5):
+    '''
+    Time per call (best of repeat rounds) and peak memory of one call [bytes].
+    The function is called once before, so the caches and workspaces are already built.
+    '''
+    function(sim)
+
+    # Number of calls per round, so that each round lasts at least min_time / repeat
+    start = time.perf_counter()
+    function(sim)
+    calls = max(1, int(min_time / repeat / max(time.perf_counter() - start, 1.e-9)))
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(calls):
+            function(sim)
+        times.append((time.perf_counter() - start) / calls)
+
+    tracemalloc.start()
+    function(sim)
+    memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return np.min(times), memory
+
+
+def compare_Baseline(results, baseline, threshold, memory_threshold):
+    '''
+    List of regressions of the results with respect to the baseline.
+    '''
+    reference = {(entry["function"], entry["Nr"], entry["Nm"], entry["Nz"]): entry for entry in baseline["results"]}
+    regressions = []
+    for entry in results:
+        old = reference.get((entry["function"], entry["Nr"], entry["Nm"], entry["Nz"]))
+        if old is None:
+            continue
+        if entry["time"] > old["time"] * (1. + threshold):
+            regressions.append("{} (Nr={}, Nm={}, Nz={}): time {:.3g} ms > {:.3g} ms".format(
+                entry["function"], entry["Nr"], entry["Nm"], entry["Nz"], 1.e3 * entry["time"], 1.e3 * old["time"]))
+        if entry["memory"] > old["memory"] * (1. + memory_threshold) + 4096:
+            regressions.append("{} (Nr={}, Nm={}, Nz={}): memory {:.3g} MB > {:.3g} MB".format(
+                entry["function"], entry["Nr"], entry["Nm"], entry["Nz"], entry["memory"] / 1024**2, old["memory"] / 1024**2))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark of the backreaction functions")
+    parser.add_argument("--output", default = "benchmark_kernels.json", help = "Results file")
+    parser.add_argument("--baseline", default = None, help = "Results file of a previous run to compare with")
+    parser.add_argument("--threshold", type = float, default = 0.25, help = "Allowed relative slowdown")
+    parser.add_argument("--memory-threshold", type = float, default = 0.1, help = "Allowed relative increase of the peak memory")
+    parser.add_argument("--repeat", type = int, default = 5, help = "Timing rounds per case")
+    args = parser.parse_args()
+
+    results = []
+    print("{:>56s} {:>5s} {:>5s} {:>5s} {:>12s} {:>12s}".format("function", "Nr", "Nm", "Nz", "time [ms]", "memory [MB]"))
+    for name, function, Nr, Nm, Nz, settings in get_Cases():
+        sim = get_StandIn(Nr, Nm, settings)
+        t, memory = run_Case(function, sim, args.repeat)
+        results.append({"function": name, "Nr": Nr, "Nm": Nm, "Nz": Nz, "time": t, "memory": memory})
+        print("{:>56s} {:5d} {:5d} {:>5s} {:12.3f} {:12.3f}".format(name, Nr, Nm, str(Nz or "-"), 1.e3 * t, memory / 1024**2))
+
+    with open(args.output, "w") as file:
+        json.dump({"numpy": np.__version__, "results": results}, file, indent = 4)
+    print("Results saved in {}".format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare_Baseline(results, baseline, args.threshold, args.memory_threshold)
+        if regressions:
+            print("Regressions with respect to {}:".format(args.baseline))
+            for regression in regressions:
+                print("    " + regression)
+            sys.exit(1)
+        print("No regressions with respect to {}".format(args.baseline))
@@ -0,0 +1,51 @@
+import numpy as np
+import sys
+import time
+
+
+sys.path.append("../")
+from functions_backreaction import VerticalIntegral_Trapz, VerticalIntegral_Quadrature
+
+
+################################
+# BENCHMARK
+################################
+'''
+Accuracy and time per call of the vertical integration schemes, as a function of the total dust-to-gas ratio.
+The columns have a gas scale height of 1, and Nm species with St from 1e-5 to 10 settled as sqrt(alpha / (alpha + St)),
+with a mass distribution Sigma_d ~ St^0.5. The reference is the quadrature with 2048 points.
+The maximum absolute errors of Ag, Bg, Ad and Bd are reported for each scheme and number of points.
+
+Usage: python benchmark_quadrature.py
+'''
+
+Nr = 100
+Nm = 120
+alpha = 1.e-3
+d2g_list = [0.01, 0.1, 1., 3., 10., 30., 100.]
+schemes = [("trapz", VerticalIntegral_Trapz, 300)] + [("quadrature", VerticalIntegral_Quadrature, Nz) for Nz in [32, 64, 96]]
+repeat = 5
+
+
+def get_Column(d2g):
+    St = np.logspace(-5, 1, Nm)
+    h_g = np.ones(Nr)
+    h_d = h_g[:, None] * np.sqrt(alpha / (alpha + St))
+    Sigma_d = St**0.5 / np.sum(St**0.5) * d2g
+    rho_g = 1. / (np.sqrt(2 * np.pi) * h_g)
+    rho_d = Sigma_d / (np.sqrt(2 * np.pi) * h_d)
+    return h_g, h_d, rho_g, rho_d, np.broadcast_to(St, (Nr, Nm)).copy()
+
+
+print("{:>7s} {:>11s} {:>5s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}".format("d2g", "scheme", "Nz", "Ag", "Bg", "Ad", "Bd", "time [ms]"))
+for d2g in d2g_list:
+    column = get_Column(d2g)
+    reference = VerticalIntegral_Quadrature(*column, Nz = 2048)
+    for name, integral, Nz in schemes:
+        coefficients = integral(*column, Nz = Nz)
+        start = time.perf_counter()
+        for i in range(repeat):
+            integral(*column, Nz = Nz)
+        elapsed = (time.perf_counter() - start) / repeat
+        errors = [np.max(np.abs(value - exact)) for value, exact in zip(coefficients, reference)]
+        print("{:7.2f} {:>11s} {:5d} {:9.1e} {:9.1e} {:9.1e} {:9.1e} {:9.1f}".format(d2g, name, Nz, *errors, elapsed * 1e3))
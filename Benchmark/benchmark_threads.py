@@ -0,0 +1,90 @@
+import numpy as np
+import sys
+import os
+import time
+
+
+from dustpy import Simulation
+from dustpy import constants as c
+
+sys.path.append("../")
+from setup_backreaction import setup_backreaction
+from functions_backreaction import update_BackreactionVerticalStructure
+
+
+################################
+# BENCHMARK
+################################
+'''
+Scaling of the vertical backreaction calculation with the number of threads (vertical_threads in setup_backreaction).
+The radial cells are split into blocks that are integrated in parallel.
+The coefficients must be identical to the serial ones.
+
+Splitting the radial cells into smaller blocks changes the time by itself (cache effects), so each thread count is also timed
+in serial with the same block size. The "speedup" column is relative to one thread, and the "parallel" column is relative
+to the serial run with the same blocks: only the latter measures the parallel scaling.
+With more threads than cores the threads share the cores, and the parallel speedup cannot exceed the number of cores.
+
+The parallel speedup on several cores has not been measured yet: the only runs so far were on a single core,
+where the parallel factors were 0.96 and 0.86 (trapz) and 0.78 and 0.91 (quadrature) for 2 and 4 threads.
+Run this benchmark on the target machine before relying on vertical_threads.
+
+Usage: python benchmark_threads.py [max_threads]
+'''
+
+def get_Simulation(threads, vertical_integration = "trapz", block = None):
+    sim = Simulation()
+
+    sim.ini.gas.alpha = 1.e-3
+    sim.ini.dust.d2gRatio = 0.01
+
+    sim.ini.grid.Nr = 250
+    sim.ini.grid.rmin = 5 * c.au
+    sim.ini.grid.rmax = 500 * c.au
+
+    sim.initialize()
+    setup_backreaction(sim, vertical_setup = True, vertical_integration = vertical_integration, vertical_threads = threads,
+                       vertical_block = block)
+    return sim
+
+
+def time_update(sim, repeat = 5):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        update_BackreactionVerticalStructure(sim)
+        times.append(time.perf_counter() - start)
+    return np.min(times)
+
+
+max_threads = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+threads = [1]
+while threads[-1] * 2 <= max_threads:
+    threads.append(threads[-1] * 2)
+if threads[-1] != max_threads:
+    threads.append(max_threads)
+
+cores = os.cpu_count()
+print("Cores: {}".format(cores))
+if max_threads > cores:
+    print("Warning: more threads than cores, the parallel speedup is bounded by {}".format(cores))
+print()
+
+for vertical_integration in ["trapz", "quadrature"]:
+    print("Vertical integration: {}".format(vertical_integration))
+    print("{:>8s} {:>8s} {:>12s} {:>12s} {:>10s} {:>10s} {:>10s}".format("threads", "block", "time [ms]", "serial [ms]", "speedup",
+                                                                        "parallel", "identical"))
+    reference = None
+    for n in threads:
+        sim = get_Simulation(n, vertical_integration)
+        t = time_update(sim)
+        coefficients = np.concatenate([sim.dust.backreaction.A_vertical, sim.dust.backreaction.B_vertical])
+        if reference is None:
+            reference = (t, coefficients)
+
+        # Serial run with the blocks of the threaded run (one block per thread)
+        block = -(-int(sim.grid.Nr) // n)
+        t_serial = time_update(get_Simulation(1, vertical_integration, block)) if n > 1 else t
+        print("{:8d} {:8d} {:12.2f} {:12.2f} {:10.2f} {:10.2f} {:>10s}".format(n, block, 1.e3 * t, 1.e3 * t_serial, reference[0] / t,
+                                                                            t_serial / t, str(np.array_equal(coefficients, reference[1]))))
+    print()
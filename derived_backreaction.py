@@ -0,0 +1,53 @@
+from functools import partial
+
+from functions_backreaction import get_field, derived_quantities
+
+
+#########################################################################################
+#
+# Cache of the derived quantities shared by the updaters (see functions_backreaction.get_derived)
+#
+#########################################################################################
+
+# Fields read by the derived quantities, updated by their own updater
+derived_updated_fields = ["dust.St", "gas.eta"]
+
+def DerivedCache_Install(sim):
+    '''
+    Install the cache of derived quantities, stored in sim.dust.backreaction._derived.
+
+    The quantities are discarded after the update of the fields they depend on (the Stokes number or eta).
+    Use DerivedCache_Invalidate after changing those fields by hand.
+    '''
+    sim.dust.backreaction._derived = {"values": {}, "computed": 0, "reused": 0}
+
+    for path in derived_updated_fields:
+        heartbeat = get_field(sim, path).updater
+        if heartbeat.updater._func is not None:
+            heartbeat.updater = partial(DerivedCache_Update, path, heartbeat.updater._func)
+
+def DerivedCache_Invalidate(sim, fields = None):
+    '''
+    Discard the derived quantities that depend on any of the given fields (paths, e.g. "dust.St"), or all of them.
+    '''
+    state = getattr(sim.dust.backreaction, "_derived", None)
+    if state is None:
+        return
+    for name in list(state["values"]):
+        if fields is None or set(fields) & set(derived_quantities[name]["reads"]):
+            del state["values"][name]
+
+def DerivedCache_Update(path, function, sim):
+    '''
+    Updater of a field read by the derived quantities. The quantities depending on it are discarded.
+    '''
+    value = function(sim)
+    DerivedCache_Invalidate(sim, [path])
+    return value
+
+def DerivedCache_Stats(sim):
+    '''
+    Counters of the derived cache: number of computed and reused derived quantities.
+    '''
+    state = getattr(sim.dust.backreaction, "_derived", {})
+    return {key: state.get(key, 0) for key in ["computed", "reused"]}
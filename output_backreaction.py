@@ -0,0 +1,117 @@
+import numpy as np
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from types import MethodType, SimpleNamespace
+from functools import partial
+from time import perf_counter
+import numbers
+
+
+#########################################################################################
+#
+# Asynchronous output: the snapshots are written by a background process while the integration continues
+#
+#########################################################################################
+
+# Background writer shared by all the simulations of the process, with the snapshots waiting to be written
+async_output = {"executor": None, "pending": deque(), "written": 0, "copy": 0.0, "wait": 0.0}
+
+def AsyncOutput_Install(sim, queue = 2):
+    '''
+    Write the snapshots of the simulation in a background process.
+    The writing function of sim.writer is wrapped with AsyncOutput_Write, so the writer keeps its configuration
+    (datadir, file names, overwrite, compression options). The dump files are still written in the main process.
+
+    The background process is started with the spawn method of multiprocessing, since forking a process that already
+    runs threads (e.g. the pool of vertical_threads) is unsafe. It imports the main script, so the script must run
+    the simulation under if __name__ == "__main__":, otherwise the process fails to start.
+    The process is shut down after the last snapshot, or when the main process exits (see AsyncOutput_Shutdown).
+    '''
+    sim.writer._func = partial(AsyncOutput_Write, sim.writer._func, queue)
+
+def AsyncOutput_Buffer(obj):
+    '''
+    Copy of the data written into a snapshot, as a tree of namespaces that the writing function can traverse.
+    It follows the rules of the hdf5 writer: hidden attributes, methods and fields with save = False are skipped,
+    and dicts are rejected with the same error. Any other object is copied as a subtree.
+    The arrays and lists are copied, so the simulation can continue while the copy is written.
+    '''
+    buffer = SimpleNamespace(_description = getattr(obj, "_description", None))
+    for key in obj.__dir__():
+        if key.startswith("_") or key in getattr(obj, "_skiplist", []):
+            continue
+        value = getattr(obj, key)
+        if (hasattr(value, "save") and not value.save) or isinstance(value, MethodType):
+            continue
+        if isinstance(value, np.ndarray):
+            value = np.array(value)
+        elif type(value) in [tuple, list]:
+            value = type(value)(value)
+        elif type(value) is dict:
+            raise NotImplementedError("Storing dict not yet implemented in hdf5writer.")
+        elif not (value is None or type(value) is str or isinstance(value, (numbers.Number, np.number))):
+            value = AsyncOutput_Buffer(value)
+        setattr(buffer, key, value)
+    return buffer
+
+def AsyncOutput_Write(func, queue, owner, filename, **options):
+    '''
+    Writing function of the asynchronous output: copies the snapshot into a buffer, and hands it to the background process.
+    If queue snapshots are already waiting, it waits for the oldest one first (this bounds the memory of the buffers).
+    The output of the last snapshot waits for all the pending ones and shuts down the background process,
+    so the run ends with every file written.
+    '''
+    start = perf_counter()
+    buffer = AsyncOutput_Buffer(owner)
+    async_output["copy"] += perf_counter() - start
+
+    start = perf_counter()
+    pending = async_output["pending"]
+    while len(pending) >= queue:
+        pending.popleft().result()
+        async_output["written"] += 1
+    if async_output["executor"] is None:
+        async_output["executor"] = ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context("spawn"))
+    pending.append(async_output["executor"].submit(func, buffer, filename, **options))
+    async_output["wait"] += perf_counter() - start
+
+    var = owner.integrator.var if getattr(owner, "integrator", None) is not None else None
+    if var is not None and var >= var.snapshots[-1]:
+        AsyncOutput_Shutdown()
+
+def AsyncOutput_Flush():
+    '''
+    Wait until all the pending snapshots are written. Errors of the background writer are raised here.
+    '''
+    start = perf_counter()
+    pending = async_output["pending"]
+    while pending:
+        pending.popleft().result()
+        async_output["written"] += 1
+    async_output["wait"] += perf_counter() - start
+
+def AsyncOutput_Shutdown():
+    '''
+    Write the pending snapshots and shut down the background process. A later snapshot starts a new one.
+    Also called when the main process exits, for the runs that stop before their last snapshot.
+    '''
+    executor = async_output["executor"]
+    if executor is None:
+        return
+    try:
+        AsyncOutput_Flush()
+    finally:
+        executor.shutdown()
+        async_output["executor"] = None
+
+atexit.register(AsyncOutput_Shutdown)
+
+def AsyncOutput_Stats():
+    '''
+    Snapshots written and pending in the background, and the time [s] the integration spent copying them into the buffers
+    and waiting for the background writer (when the queue was full, or at the flush).
+    '''
+    return {"written": async_output["written"], "pending": len(async_output["pending"]),
+            "copy": async_output["copy"], "wait": async_output["wait"]}
@@ -0,0 +1,157 @@
+import numpy as np
+import sys
+import os
+import glob
+import h5py
+
+from dustpy import hdf5writer
+
+from functions_backreaction import default_settings
+from functions_backreaction import UniformCoefficients
+from functions_backreaction import VerticalCoefficients, VerticalIntegral_Scheme, JointCoefficients_VerticalStructure
+
+
+################################
+# OFFLINE BACKREACTION COEFFICIENTS
+################################
+'''
+Computes the backreaction coefficients A, B (and A_vertical, B_vertical for the vertical setup) for every snapshot
+of a simulation output, without building a Simulation object.
+
+Only the needed datasets are read from the snapshot files (gas Sigma, Hp, rho and dust Sigma, St, H, rho),
+one batch of snapshots at a time. Each batch is computed in one call of the batch functions of functions_backreaction.
+The memory setting bounds both the batch size and the vertical integration arrays.
+The results are written into a single compressed HDF5 file, with the snapshot (time) as the leading axis.
+
+Read_Snapshot loads a single snapshot, and recomputes the backreaction fields that are not written into it.
+
+Usage: python postprocess_backreaction.py datadir output.hdf5 [uniform | trapz | quadrature]
+'''
+
+# Datasets needed by each setup
+snapshot_datasets = {
+    "uniform": ["gas/Sigma", "dust/Sigma", "dust/St"],
+    "vertical": ["gas/Hp", "gas/rho", "dust/H", "dust/rho", "dust/St"],
+}
+
+
+def Snapshot_Files(datadir):
+    '''
+    Sorted list of the snapshot files (data*.hdf5) in the datadir.
+    '''
+    return sorted(glob.glob(os.path.join(datadir, "data*.hdf5")))
+
+
+def Read_Snapshots(files, datasets):
+    '''
+    Reads the datasets of the given snapshot files, stacked along a leading time axis.
+    Returns a dictionary with the dataset names (and "t") as keys.
+    '''
+    data = {name: [] for name in datasets + ["t"]}
+    for filename in files:
+        with h5py.File(filename, "r") as file:
+            for name in data:
+                data[name].append(file[name][()])
+    return {name: np.array(values) for name, values in data.items()}
+
+
+def Coefficients_Batch(data, vertical = False, settings = default_settings):
+    '''
+    Backreaction coefficients for a batch of snapshots (see Read_Snapshots), with a leading time axis (nt).
+    Returns A, B (nt, nr), and for the vertical setup also A_vertical, B_vertical (nt, nr, nm).
+
+    All the snapshots are computed in one call of the batch functions. As in the simulation,
+    the last cell of each snapshot is set to the default values (A=1, B=0).
+    '''
+    if not vertical:
+        coefficients = list(UniformCoefficients(data["gas/Sigma"], data["dust/Sigma"], data["dust/St"]))
+    else:
+        coefficients = list(VerticalCoefficients(data["gas/Hp"], data["dust/H"], data["gas/rho"], data["dust/rho"], data["dust/St"],
+                                                 dict(settings, threads = 1)))
+
+    for value, default in zip(coefficients, [1.0, 0.0, 1.0, 0.0]):
+        value[:, -1] = default
+    return coefficients
+
+
+def Read_Snapshot(filename, vertical = False, settings = default_settings):
+    '''
+    Reads a snapshot file with the dustpy reader, and reconstructs the backreaction fields that were not written:
+    the joint AB (from A and B, and A_vertical, B_vertical in the vertical setup), and A_vertical, B_vertical of the vertical setup
+    with the lean output (see setup_backreaction), recomputed with the given settings (integration scheme, Nz, hybrid, precision).
+
+    The recomputed coefficients are those of a full update of the snapshot state,
+    so they match the simulation unless it used the sub-cycling or the incremental update.
+    '''
+    data = hdf5writer().read.output(filename)
+    backreaction = data.dust.backreaction
+    if not vertical:
+        if not hasattr(backreaction, "AB"):
+            backreaction.AB = np.array([backreaction.A, backreaction.B])
+    else:
+        if not hasattr(backreaction, "A_vertical"):
+            batch = {}
+            for name in snapshot_datasets["vertical"]:
+                group, field = name.split("/")
+                batch[name] = getattr(getattr(data, group), field)[None, ...]
+            coefficients = Coefficients_Batch(batch, True, settings)
+            backreaction.A_vertical = coefficients[2][0]
+            backreaction.B_vertical = coefficients[3][0]
+        if not hasattr(backreaction, "AB"):
+            backreaction.AB = JointCoefficients_VerticalStructure(backreaction.A, backreaction.B,
+                                                                  backreaction.A_vertical, backreaction.B_vertical)
+    return data
+
+
+def BackreactionCoefficients_Snapshots(files, output, vertical = False, integration = "trapz", Nz = None, memory = 256):
+    '''
+    Computes the backreaction coefficients of every snapshot file and writes them into the output HDF5 file:
+    "t" (nt), "A", "B" (nt, nr), and for the vertical setup "A_vertical", "B_vertical" (nt, nr, nm).
+
+    vertical:       Consider the vertical structure (as setup_backreaction(vertical_setup = True)).
+    integration:    Vertical integration scheme, "trapz" or "quadrature".
+    Nz:             Number of vertical grid points (None for the default of the scheme).
+    memory:         Memory ceiling in MB for each batch of snapshots, and for the vertical integration arrays.
+    '''
+    settings = dict(default_settings, integration = integration, Nz = Nz, memory = memory * 1024**2)
+    datasets = snapshot_datasets["vertical" if vertical else "uniform"]
+
+    with h5py.File(files[0], "r") as file:
+        Nr, Nm = file["dust/St"].shape
+        r = file["grid/r"][()]
+    Nt = len(files)
+
+    # Snapshots per batch: input datasets and results
+    bytes_per_snapshot = (len(datasets) + (4 if vertical else 0)) * Nr * Nm * 8
+    batch = max(1, min(Nt, int(settings["memory"] // (2 * bytes_per_snapshot))))
+
+    names = ["A", "B", "A_vertical", "B_vertical"] if vertical else ["A", "B"]
+    with h5py.File(output, "w") as file:
+        file.attrs["vertical"] = vertical
+        if vertical:
+            file.attrs["integration"] = integration
+            file.attrs["Nz"] = VerticalIntegral_Scheme(settings)[1]
+        file.create_dataset("files", data = np.array([os.path.basename(filename) for filename in files], dtype = "S"))
+        file.create_dataset("r", data = r)
+        t = file.create_dataset("t", (Nt,), dtype = float)
+        results = {}
+        for name in names:
+            shape = (Nt, Nr, Nm) if name.endswith("vertical") else (Nt, Nr)
+            results[name] = file.create_dataset(name, shape, dtype = float, chunks = (1,) + shape[1:], compression = "lzf")
+
+        for i in range(0, Nt, batch):
+            data = Read_Snapshots(files[i : i + batch], datasets)
+            t[i : i + batch] = data["t"]
+            for name, value in zip(names, Coefficients_Batch(data, vertical, settings)):
+                results[name][i : i + batch] = value
+
+
+if __name__ == "__main__":
+    datadir, output = sys.argv[1], sys.argv[2]
+    setup = sys.argv[3] if len(sys.argv) > 3 else "uniform"
+    files = Snapshot_Files(datadir)
+    if setup == "uniform":
+        BackreactionCoefficients_Snapshots(files, output)
+    else:
+        BackreactionCoefficients_Snapshots(files, output, vertical = True, integration = setup)
+    print("Backreaction coefficients of {} snapshots written into {}".format(len(files), output))
@@ -0,0 +1,233 @@
+from dustpy import std
+import numpy as np
+from functools import partial
+
+from functions_backreaction import get_field
+
+
+#########################################################################################
+#
+# Update scheduler: run the velocity, flux and source updates once per step, in dependency order
+#
+#########################################################################################
+
+# Fields read and written by each updater.
+# The backreaction updaters are installed by setup_backreaction. The others are the dustpy updates that depend on them,
+# called in the finalizer of the implicit integration scheme (and often again in systoles that modify the surface densities).
+updater_dependencies = {
+    "dust.backreaction.AB": {"reads": ["gas.Sigma", "dust.Sigma", "dust.St"], "writes": ["dust.backreaction.AB"]},
+    "dust.backreaction.A":  {"reads": ["dust.backreaction.AB"], "writes": ["dust.backreaction.A"]},
+    "dust.backreaction.B":  {"reads": ["dust.backreaction.AB"], "writes": ["dust.backreaction.B"]},
+    "dust.backreaction":    {"reads": ["gas.Hp", "gas.rho", "dust.H", "dust.rho", "dust.St"],
+                             "writes": ["dust.backreaction.A", "dust.backreaction.B",
+                                        "dust.backreaction.A_vertical", "dust.backreaction.B_vertical"]},
+    "dust.D":               {"reads": ["gas.Sigma", "dust.Sigma", "dust.delta.rad", "gas.cs", "dust.St"], "writes": ["dust.D"]},
+    "gas.v.visc":           {"reads": ["gas.Sigma", "gas.nu"], "writes": ["gas.v.visc"]},
+    "gas.v.rad":            {"reads": ["gas.v.visc", "gas.eta", "gas.torque.v", "grid.OmegaK", "dust.backreaction.A", "dust.backreaction.B"],
+                             "writes": ["gas.v.rad"]},
+    "gas.Fi":               {"reads": ["gas.Sigma", "gas.v.rad"], "writes": ["gas.Fi"]},
+    "gas.S.hyd":            {"reads": ["gas.Fi"], "writes": ["gas.S.hyd"]},
+    "dust.v.driftmax":      {"reads": ["gas.v.visc", "gas.eta", "dust.backreaction.A", "dust.backreaction.B"], "writes": ["dust.v.driftmax"]},
+    "dust.v.rad":           {"reads": ["dust.St", "gas.v.visc", "gas.v.rad", "gas.eta", "grid.OmegaK", "dust.v.driftmax",
+                                       "dust.backreaction.A_vertical", "dust.backreaction.B_vertical"], "writes": ["dust.v.rad"]},
+    "dust.Fi.adv":          {"reads": ["dust.Sigma", "dust.v.rad"], "writes": ["dust.Fi.adv"]},
+    "dust.Fi.diff":         {"reads": ["dust.Sigma", "gas.Sigma", "dust.D"], "writes": ["dust.Fi.diff"]},
+    "dust.Fi.tot":          {"reads": ["dust.Fi.adv", "dust.Fi.diff"], "writes": ["dust.Fi.tot"]},
+    "dust.S.hyd":           {"reads": ["dust.Fi.tot"], "writes": ["dust.S.hyd"]},
+    "dust.S.coag":          {"reads": ["dust.Sigma", "dust.kernel", "dust.p"], "writes": ["dust.S.coag"]},
+}
+
+# Updates that the scheduler collects during the finalization of a step, and runs once before the next update of the simulation
+scheduled_updates = ["gas.v.visc", "gas.v.rad", "gas.Fi", "gas.S.hyd",
+                     "dust.v.rad", "dust.Fi.adv", "dust.Fi.diff", "dust.Fi.tot", "dust.S.hyd", "dust.S.coag"]
+
+# Scheduled updates that are skipped outside of the finalization window when neither the fields they read nor their own value
+# changed since they last ran (e.g. gas.v.visc in the velocity_update diastole, right after the scheduled updates of the step)
+scheduler_checked_updates = ["gas.v.visc", "gas.v.rad", "dust.v.rad"]
+
+# Boundary steps of the dustpy finalizers, with the scheduled fields they write (at the first and last cells).
+# They run at the end of the finalizer, after the updates of those fields, so the scheduler runs them again after the updates
+scheduler_boundaries = {
+    std.sim.finalize_implicit_dust: [(std.gas.set_implicit_boundaries, ["gas.Fi", "gas.S.hyd"]),
+                                     (std.dust.set_implicit_boundaries, ["dust.Fi.adv", "dust.Fi.tot", "dust.S.hyd"])],
+    std.sim.finalize_explicit_dust: [(std.gas.set_implicit_boundaries, ["gas.Fi", "gas.S.hyd"])],
+}
+
+def has_field(sim, path):
+    '''
+    Whether the simulation has a field (or group) at the given path.
+    '''
+    try:
+        get_field(sim, path)
+    except AttributeError:
+        return False
+    return True
+
+def Scheduler_Order(names):
+    '''
+    Sorts the updates so that every update runs after the updates that write the fields it reads.
+    Updates without dependencies between them keep the order of updater_dependencies.
+    '''
+    names = [name for name in updater_dependencies if name in names]
+    order = []
+    while names:
+        for name in names:
+            # An update is ready when none of the remaining updates writes what it reads
+            reads = set(updater_dependencies[name]["reads"])
+            if not any(reads & set(updater_dependencies[other]["writes"]) for other in names if other != name):
+                break
+        else:
+            raise ValueError("Circular dependency between the updates: {}".format(names))
+        order.append(name)
+        names.remove(name)
+    return order
+
+def Scheduler_Install(sim):
+    '''
+    Install the update scheduler.
+
+    During the finalization of an integration step (and the systole of the simulation update that follows),
+    the updates of the scheduled_updates fields are only requested.
+    Each requested update runs once, in dependency order (see Scheduler_Order), at the start of the simulation update
+    (or before the next integration step). Repeated requests in the same step are eliminated (see Scheduler_Stats).
+    Outside of that window, the updates run immediately as usual, except for the scheduler_checked_updates fields,
+    which are skipped when the fields they read and their own value are unchanged since their last update
+    (e.g. the velocity_update diastole, and the update of the velocities at the end of setup_backreaction).
+
+    The boundary step of the dustpy finalizer (see scheduler_boundaries) runs again after the requested updates,
+    for the fields that were not requested again after the finalizer (e.g. by a systole that fixes the boundaries).
+    The results are the same as without the scheduler (see Benchmark/benchmark_Scheduler.py),
+    unless a systole changes the surface densities without requesting the updates of the fluxes.
+
+    The scheduler wraps the systole of the simulation, and the finalizer and preparator of the integrator.
+    Set them before the installation: the finalizer raises a RuntimeError if the systole or the preparator
+    were replaced afterwards, since the requested updates would then not run before the simulation update.
+    A finalizer replaced afterwards only disables the scheduler.
+    '''
+    sim.dust.backreaction._scheduler = {"deferring": False, "finalizing": False, "pending": [], "boundaries": [], "requested": [],
+                                         "inputs": {}, "last": {},
+                                         "steps": 0, "computed": 0, "eliminated": 0, "eliminated_per_field": {}}
+
+    # Fields read by the checked updates that exist in this setup (e.g. no A_vertical without the vertical structure)
+    inputs = sim.dust.backreaction._scheduler["inputs"]
+    for path in scheduler_checked_updates:
+        inputs[path] = [name for name in updater_dependencies[path]["reads"] if has_field(sim, name)]
+
+    for path in scheduled_updates:
+        heartbeat = get_field(sim, path).updater
+        if heartbeat.updater._func is not None:
+            heartbeat.updater = partial(Scheduled_Update, path, heartbeat.updater._func)
+
+    # The original finalizer may already be wrapped
+    finalizer = sim.integrator.finalizer.updater._func
+    original = finalizer
+    while isinstance(original, partial):
+        original = original.args[0]
+    boundaries = scheduler_boundaries.get(original, [])
+    sim.integrator.finalizer.updater = partial(Scheduler_Finalize, finalizer, boundaries)
+    sim.integrator.preparator.updater = partial(Scheduler_Prepare, sim.integrator.preparator.updater._func)
+    sim.updater.systole = partial(Scheduler_Systole, sim.updater.systole._func)
+    # To detect a systole or preparator replaced after the installation
+    sim.dust.backreaction._scheduler["installed"] = [sim.updater.systole._func, sim.integrator.preparator.updater._func]
+
+def Scheduled_Update(path, function, sim):
+    '''
+    Updater of a scheduled field. Requests the update while the scheduler is deferring, otherwise runs it.
+    '''
+    state = sim.dust.backreaction._scheduler
+    if not state["deferring"]:
+        if path not in state["inputs"]:
+            return function(sim)
+        return Scheduled_CheckedUpdate(path, function, sim)
+    if not state["finalizing"] and path not in state["requested"]:
+        state["requested"].append(path)
+    if path in state["pending"]:
+        state["eliminated"] += 1
+        state["eliminated_per_field"][path] = state["eliminated_per_field"].get(path, 0) + 1
+    else:
+        state["pending"].append(path)
+    return None     # The field keeps its value until the update runs
+
+def Scheduled_CheckedUpdate(path, function, sim):
+    '''
+    Run the update of a checked field, unless the fields it reads and its own value are the same as after its last update.
+    '''
+    state = sim.dust.backreaction._scheduler
+    names = state["inputs"][path] + [path]
+    last = state["last"].get(path)
+    if last is not None and all(np.array_equal(get_field(sim, name), value) for name, value in zip(names, last)):
+        state["eliminated"] += 1
+        state["eliminated_per_field"][path] = state["eliminated_per_field"].get(path, 0) + 1
+        return None     # The field keeps its value
+    value = function(sim)
+    # The values the update was computed from, and its result
+    state["last"][path] = [np.array(get_field(sim, name)) for name in names[:-1]] + [np.array(value)]
+    return value
+
+def Scheduler_Flush(sim):
+    '''
+    Run the requested updates once, in dependency order, then the boundary steps of the finalizer, and stop deferring.
+    '''
+    state = sim.dust.backreaction._scheduler
+    state["deferring"] = False
+    boundaries, requested = state["boundaries"], state["requested"]
+    state["boundaries"], state["requested"] = [], []
+    if not state["pending"]:
+        return
+    for path in Scheduler_Order(state["pending"]):
+        get_field(sim, path).update()
+        state["computed"] += 1
+    state["pending"] = []
+    state["steps"] += 1
+
+    # The boundary values of the fields requested again after the finalizer are those of their last update
+    for boundary, paths in boundaries:
+        if all(path in requested for path in paths):
+            continue
+        kept = [(get_field(sim, path), np.array(get_field(sim, path)[[0, -1]])) for path in paths if path in requested]
+        boundary(sim)
+        for field, value in kept:
+            field[[0, -1]] = value
+
+def Scheduler_Finalize(finalizer, boundaries, sim):
+    '''
+    Integrator finalizer: collect the update requests of the original finalizer.
+    Its boundary steps are run again after the requested updates (see Scheduler_Flush).
+    '''
+    state = sim.dust.backreaction._scheduler
+    if [sim.updater.systole._func, sim.integrator.preparator.updater._func] != state["installed"]:
+        raise RuntimeError("The systole of the simulation or the preparator of the integrator was replaced after "
+                           "the installation of the update scheduler. Set them before setup_backreaction.")
+    state["deferring"] = True
+    state["finalizing"] = True
+    if finalizer is not None:
+        finalizer(sim)
+    state["finalizing"] = False
+    state["boundaries"] = boundaries
+    state["requested"] = []
+
+def Scheduler_Systole(systole, sim):
+    '''
+    Systole of the simulation update: collect the requests of the original systole, then run all the requested updates.
+    '''
+    if systole is not None:
+        systole(sim)
+    Scheduler_Flush(sim)
+
+def Scheduler_Prepare(preparator, sim):
+    '''
+    Integrator preparator: run any update still pending before the integration step.
+    '''
+    Scheduler_Flush(sim)
+    if preparator is not None:
+        preparator(sim)
+
+def Scheduler_Stats(sim):
+    '''
+    Counters of the update scheduler: number of steps, and number of computed and eliminated updates
+    (repeated requests, and checked updates with unchanged inputs).
+    '''
+    state = getattr(sim.dust.backreaction, "_scheduler", {})
+    stats = {key: state.get(key, 0) for key in ["steps", "computed", "eliminated"]}
+    stats["eliminated_per_field"] = dict(state.get("eliminated_per_field", {}))
+    return stats
@@ -1,15 +1,28 @@
 import dustpy
 import numpy as np
 
-from functions_backreaction import BackreactionCoefficients, BackreactionCoefficients_VerticalStructure
-from functions_backreaction import Backreaction_A, Backreaction_B, Backreaction_A_VerticalStructure, Backreaction_B_VerticalStructure
-from functions_backreaction import vrad_dust_BackreactionVerticalStructure
+from functions_backreaction import BackreactionCoefficients, update_BackreactionVerticalStructure
+from functions_backreaction import Backreaction_A, Backreaction_B
+from functions_backreaction import vrad_dust_Backreaction, vrad_dust_BackreactionVerticalStructure
 from functions_backreaction import dustDiffusivity_Backreaction
+from functions_backreaction import default_settings
+from functions_backreaction import VerticalCache, VerticalIntegral_Scheme
+from functions_backreaction import Instrumentation_Install, Instrumentation_Reset
+from functions_backreaction import Subcycle_Install, Subcycle_Reset
+from scheduler_backreaction import Scheduler_Install
+from derived_backreaction import DerivedCache_Install
+from output_backreaction import AsyncOutput_Install
 
 ################################
 # Helper routine to add backreaction to your Simulation object in one line.
 ################################
-def setup_backreaction(sim, vertical_setup = False, velocity_update = False):
+def setup_backreaction(sim, vertical_setup = False, velocity_update = False, vertical_integration = "trapz", vertical_Nz = None,
+                       vertical_block = None, vertical_memory = None, vertical_threads = 1, vertical_hybrid = None,
+                       vertical_precision = "float64", vertical_precision_check = 100, vertical_profile_tolerance = 0.0,
+                       incremental = False, incremental_threshold = 1.e-3, subcycle = None, subcycle_tolerance = None,
+                       instrumentation = False, instrumentation_output = False,
+                       scheduler = False, derived_cache = False, output_lean = False, output_compression = None,
+                       output_async = False, output_queue = 2):
     '''
     Add the backreaction setup to your simulation object.
     Call the backreaction setup function after the initialization and then run, as follows:
@@ -17,53 +30,181 @@ def setup_backreaction(sim, vertical_setup = False, velocity_update = False):
     sim.initialize()
     setup_backreaction(sim)
     sim.run()
+
+    Options for the vertical setup:
+    vertical_integration:   "trapz" for the trapezoidal rule over 300 points (default),
+                            or "quadrature" for the gaussian-weighted quadrature over 32 points (~6 times faster, but with errors of A
+                            ~8 times larger: 1e-3 - 3e-3 for dust-to-gas ratios of 0.1 - 100). With vertical_Nz = 96 it matches
+                            the accuracy of "trapz", and is ~1.5 times faster (see Benchmark/benchmark_quadrature.py).
+    vertical_Nz:            Number of vertical grid points, to override the default of the integration scheme.
+    vertical_block:         Number of radial cells integrated at once, reusing the same workspace buffers.
+    vertical_memory:        Memory ceiling in MB for the vertical integration arrays (sets the block size).
+                            The coefficients do not depend on the block size.
+    vertical_threads:       Number of threads integrating the radial blocks in parallel (same result as in serial).
+                            The speedup on several cores is unverified (only single core runs, where the threads are slower),
+                            see Benchmark/benchmark_threads.py to measure it.
+    vertical_hybrid:        Threshold on |1 - h_d / h_g| below which a dust species is treated as well mixed (None to integrate all).
+                            The well mixed species are not integrated, but added analytically as a single species with the gas profile.
+                            See functions_backreaction.HybridVertical_Stats for the fraction of mixed species and the error bound.
+                            With "trapz" it is 1.4, 1.6 and 1.8 times faster for thresholds 0.01, 0.05 and 0.2 (Nr = 100, Nm = 120,
+                            after 1e5 years), with errors of 5e-5, 3e-4 and 1e-3. With "quadrature" it is slower (0.7 - 0.9 times).
+    vertical_precision:     "float64" (default), "float32" for the vertical integration arrays in single precision (half the memory),
+                            or "mixed" for single precision arrays with the sums over the mass and height accumulated in double precision.
+    vertical_precision_check: Number of updates between comparisons of the reduced precision coefficients with float64 (None to disable).
+                            See functions_backreaction.ReducedPrecision_Stats for the maximum relative deviation.
+    vertical_profile_tolerance: With "quadrature", the cached dust profiles of a radial cell are only rebuilt when a scale height
+                            ratio h_d / h_g changed by more than this (relative) since they were built (0 rebuilds on any change).
+                            See functions_backreaction.VerticalCache_Stats for the hit rate. With 1e-4, the hit rate goes from 1%
+                            to 99.5% and the update of the coefficients is 3.3 times faster (Nr = 100, Nm = 205, over 300 years),
+                            with changes of the coefficients below 1e-4.
+
+    Incremental update:
+    incremental:            Recompute the backreaction coefficients only in the cells where the gas and dust surface densities,
+                            the Stokes number or the dust scale height changed by more than incremental_threshold (relative),
+                            since the last time the cell was computed.
+                            See functions_backreaction.IncrementalUpdate_Stats for the number of skipped cells.
+
+    Sub-cycling:
+    subcycle:               Refresh the backreaction coefficients (AB, or all the vertical coefficients) only every subcycle steps.
+    subcycle_tolerance:     Refresh them also when the total dust-to-gas ratio changed by more than subcycle_tolerance
+                            (relative to 1 + d2g) in any cell since the last refresh. Can be used with or without subcycle.
+                            See functions_backreaction.Subcycle_Stats for the skipped updates and how stale the coefficients got.
+
+    Instrumentation:
+    instrumentation:        Count the calls and the wall time of every updater installed here.
+                            The [calls, time] of each updater are kept in the fields of the group sim.dust.backreaction.timing,
+                            see functions_backreaction.Instrumentation_Stats for a summary. No overhead if disabled.
+    instrumentation_output: Write the timing fields into the snapshots.
+
+    Update scheduler:
+    scheduler:              Run the gas and dust velocity, flux and source updates once per step, in dependency order,
+                            instead of once in the integrator finalizer and again in every systole that requests them.
+                            The velocities are not updated again by the velocity_update diastole when their inputs did not change.
+                            Set the systole of the simulation and the integrator before this setup: the scheduler wraps them,
+                            and stops the run with a RuntimeError if the systole or the preparator are replaced afterwards.
+                            See scheduler_backreaction.Scheduler_Install, and Scheduler_Stats for the number of eliminated updates.
+
+    Derived quantities:
+    derived_cache:          Compute the quantities shared by the updaters (1 + St^2 and eta r OmegaK) once,
+                            and reuse them until the Stokes number or eta are updated. In the simple setup, the radial dust velocity
+                            is then computed here with the 1 + St^2 of the backreaction coefficients (same values as dustpy).
+                            See derived_backreaction.DerivedCache_Install, and DerivedCache_Stats for the number of reused values.
+
+    Snapshot output:
+    output_lean:            Do not write A_vertical and B_vertical into the snapshots (vertical setup). They are recomputed from the
+                            snapshot on load by postprocess_backreaction.Read_Snapshot (exact without sub-cycling or incremental update).
+                            The internal joint field AB of the simple setup (a copy of A and B) is never written.
+                            In the vertical setup, the joint layout [A, B, A_vertical.T, B_vertical.T] is not kept as a field:
+                            it is built on demand by functions_backreaction.BackreactionCoefficients_Joint, and by Read_Snapshot.
+    output_compression:     Compression of the snapshot datasets as (method, options), e.g. ("gzip", 4) for smaller files.
+                            None keeps the writer default (lzf). The compressed datasets are chunked by h5py.
+    output_async:           Write the snapshots in a background process, while the integration continues.
+                            Each snapshot is copied into a buffer, and the files are complete when the run ends.
+                            See output_backreaction.AsyncOutput_Install, and AsyncOutput_Stats for the time spent on the output.
+                            The script must run the simulation under if __name__ == "__main__": (the background process is started with spawn, and imports it).
+    output_queue:           Maximum number of snapshots waiting to be written (bounds the memory of the buffers).
     '''
 
+    # Store the module settings
+    sim.dust.backreaction._settings = dict(default_settings)
+    sim.dust.backreaction._settings["integration"] = vertical_integration
+    sim.dust.backreaction._settings["Nz"] = vertical_Nz
+    sim.dust.backreaction._settings["block"] = vertical_block
+    sim.dust.backreaction._settings["memory"] = None if vertical_memory is None else vertical_memory * 1024**2
+    sim.dust.backreaction._settings["threads"] = vertical_threads
+    sim.dust.backreaction._settings["hybrid"] = vertical_hybrid
+    sim.dust.backreaction._settings["precision"] = vertical_precision
+    sim.dust.backreaction._settings["precision_check"] = vertical_precision_check
+    sim.dust.backreaction._settings["profile_tolerance"] = vertical_profile_tolerance
+    sim.dust.backreaction._settings["incremental"] = incremental
+    sim.dust.backreaction._settings["threshold"] = incremental_threshold
+    sim.dust.backreaction._settings["subcycle"] = subcycle
+    sim.dust.backreaction._settings["subcycle_tolerance"] = subcycle_tolerance
+
+    # Updaters are installed as they are, or wrapped with a timer and a call counter in the instrumentation mode
+    def install(name, function):
+        if not instrumentation:
+            return function
+        return Instrumentation_Install(sim, name, function, save = instrumentation_output)
+
+    # The coefficients are refreshed every step, or only when needed in the sub-cycling mode
+    def coefficients(function):
+        if subcycle is None and subcycle_tolerance is None:
+            return function
+        return Subcycle_Install(sim, function)
 
     if vertical_setup:
-        # Set the backreaction coefficients
-        sim.dust.backreaction.addfield("AB", np.ones((2 * (sim.grid.Nm[0] + 1), sim.grid.Nr[0])),  description = "Backreaction Coefficients (joint - internal)")
-
         # Additional back-reaction coefficients for the dust
-        sim.dust.backreaction.addfield("A_vertical", np.ones_like(sim.dust.a) ,  description = "Backreaction Coefficient A, considering dust vertical settling")
-        sim.dust.backreaction.addfield("B_vertical", np.zeros_like(sim.dust.a),  description = "Backreaction Coefficient B, considering dust vertical settling")
-
-
-        sim.dust.backreaction.updater = ["AB","A", "B", "A_vertical", "B_vertical"]
-        sim.dust.backreaction.AB.updater = BackreactionCoefficients_VerticalStructure
-
-        # The standard backreaction coefficients are used for the gas dynamics
-        sim.dust.backreaction.A.updater = Backreaction_A
-        sim.dust.backreaction.B.updater = Backreaction_B
+        # In the lean output they are not written into the snapshots (see postprocess_backreaction.Read_Snapshot)
+        sim.dust.backreaction.addfield("A_vertical", np.ones_like(sim.dust.a) ,  description = "Backreaction Coefficient A, considering dust vertical settling",
+                                       save = not output_lean)
+        sim.dust.backreaction.addfield("B_vertical", np.zeros_like(sim.dust.a),  description = "Backreaction Coefficient B, considering dust vertical settling",
+                                       save = not output_lean)
+
+        # All the coefficients are computed together and written directly into their fields
+        # The standard backreaction coefficients A, B are used for the gas dynamics
         # The backreaction coefficients A_vertical and B_vertical are used for the dust dynamics
-        sim.dust.backreaction.A_vertical.updater = Backreaction_A_VerticalStructure
-        sim.dust.backreaction.B_vertical.updater = Backreaction_B_VerticalStructure
+        sim.dust.backreaction.updater = install("backreaction", coefficients(update_BackreactionVerticalStructure))
+        sim.dust.backreaction.A.updater = None
+        sim.dust.backreaction.B.updater = None
 
         # Redefine the radial dust velocity to consider one pair of backreaction coefficients per dust species
-        sim.dust.v.rad.updater = vrad_dust_BackreactionVerticalStructure
+        sim.dust.v.rad.updater = install("v_rad", vrad_dust_BackreactionVerticalStructure)
+
+        # Cache of the vertical grid and profiles, reused across timesteps
+        # Call functions_backreaction.InvalidateVerticalCache(sim) to rebuild it
+        VerticalCache(sim, vertical_integration, VerticalIntegral_Scheme(sim.dust.backreaction._settings)[1], vertical_precision)
 
     else:
         # Set the backreaction coefficients
-        sim.dust.backreaction.addfield("AB", np.array([np.ones_like(sim.grid.r), np.zeros_like(sim.grid.r)]),  description = "Backreaction Coefficients (joint - internal)")
+        # The joint field is not written into the snapshots, since it holds the same values as A and B
+        sim.dust.backreaction.addfield("AB", np.array([np.ones_like(sim.grid.r), np.zeros_like(sim.grid.r)]),  description = "Backreaction Coefficients (joint - internal)",
+                                       save = False)
 
         sim.dust.backreaction.updater = ["AB","A", "B"]
-        sim.dust.backreaction.AB.updater = BackreactionCoefficients
-        sim.dust.backreaction.A.updater = Backreaction_A
-        sim.dust.backreaction.B.updater = Backreaction_B
+        sim.dust.backreaction.AB.updater = install("AB", coefficients(BackreactionCoefficients))
+        sim.dust.backreaction.A.updater = install("A", Backreaction_A)
+        sim.dust.backreaction.B.updater = install("B", Backreaction_B)
 
+        # Share 1 + St^2 between the backreaction coefficients and the radial dust velocity
+        if derived_cache:
+            sim.dust.v.rad.updater = install("v_rad", vrad_dust_Backreaction)
 
 
+
+    # Compression of the snapshots
+    if output_compression is not None and sim.writer is not None:
+        sim.writer.options = {"com": output_compression[0], "comopts": output_compression[1]}
+
+    # Background writing of the snapshots
+    if output_async and sim.writer is not None:
+        AsyncOutput_Install(sim, output_queue)
+
     # Update the dust diffusivity to account for high dust-to-gas ratios
-    sim.dust.D.updater = dustDiffusivity_Backreaction
+    sim.dust.D.updater = install("D", dustDiffusivity_Backreaction)
 
 
     # Update the gas and dust velocities in dust.v.diastole
     # Not necessary for implicit simulations(?)
     if velocity_update:
         from functions_backreaction import update_RadialVelocities
-        sim.dust.v.diastole = update_RadialVelocities
+        sim.dust.v.updater.diastole = install("velocity_update", update_RadialVelocities)
 
-    # Update all
+    # Share the derived quantities between the updaters, from the first update on
+    if derived_cache:
+        DerivedCache_Install(sim)
+
+    # Collect the velocity, flux and source updates of each step, and run them once
+    if scheduler:
+        Scheduler_Install(sim)
+
+    # Update all (with the scheduler, the velocities already updated by the velocity_update diastole are not updated again)
     sim.update()
     sim.gas.v.rad.update()
     sim.dust.v.rad.update()
+
+    # Only count the calls of the simulation run
+    if instrumentation:
+        Instrumentation_Reset(sim)
+    if subcycle is not None or subcycle_tolerance is not None:
+        Subcycle_Reset(sim)
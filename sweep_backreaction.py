@@ -0,0 +1,180 @@
+import numpy as np
+import sys
+import os
+import json
+import time
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+
+from dustpy import Simulation
+from dustpy import readdump
+from dustpy import constants as c
+
+from setup_backreaction import setup_backreaction
+
+
+################################
+# PARAMETER SWEEP
+################################
+'''
+Runs a grid of backreaction simulations (as in run_backreaction.py) in parallel, one simulation per process.
+
+Each run is written to its own datadir, named after its parameters.
+When a run finishes, a "run_summary.json" file is written in its datadir, and the run is skipped if the sweep is repeated.
+Interrupted runs are resumed from their last dump file ("frame.dmp").
+The wall time and number of steps of every run are collected into "sweep_summary.csv" in the sweep datadir.
+
+Usage: python sweep_backreaction.py [number of processes]
+
+Tip: set OMP_NUM_THREADS=1 before launching, so that the processes do not compete for the BLAS threads.
+'''
+
+# Parameter grid. Every combination is one simulation
+parameter_grid = {
+    "alpha": [1.e-4, 1.e-3],
+    "d2gRatio": [0.01, 0.05],
+    "vfrag": [100.0, 1000.0],
+    "vertical_setup": [False, True],
+}
+
+sweep_datadir = "./Sweep/"
+snapshots = np.linspace(0.5, 5.0, 10) * 1.e5 * c.year
+
+summary_filename = "run_summary.json"
+summary_columns = ["name", "status", "alpha", "d2gRatio", "vfrag", "vertical_setup", "walltime", "steps", "resumed"]
+
+
+def get_Simulation(alpha = 1.e-3, d2gRatio = 0.01, vfrag = 1000.0, vertical_setup = False):
+    sim = Simulation()
+
+    ################################
+    # DISK SETUP
+    ################################
+
+    # Relevant Dust parameters for backreaction experiments
+    sim.ini.gas.alpha = alpha
+    sim.ini.dust.d2gRatio = d2gRatio
+    sim.ini.dust.vFrag = vfrag
+
+    ################################
+    # GRID SETUP
+    ################################
+
+    # Radial Grid Parameters
+    sim.ini.grid.Nr = 200
+    sim.ini.grid.rmin = 5 * c.au
+    sim.ini.grid.rmax = 500 * c.au
+
+    sim.initialize()
+
+    ################################
+    # BACKREACTION SETUP
+    ################################
+    setup_backreaction(sim, vertical_setup = vertical_setup)
+
+    return sim
+
+
+def run_name(parameters):
+    '''
+    Name of the run (and of its datadir) from its parameters.
+    '''
+    return "_".join("{}{}".format(key, parameters[key]) for key in sorted(parameters))
+
+
+def count_step(sim):
+    '''
+    Diastole of the simulation updater, called once per integration step.
+    Counts the steps and the wall time of the run. Both are stored in the dump files, and continue after a resume.
+    '''
+    now = time.perf_counter()
+    sim._steps += 1
+    sim._walltime += now - sim._clock
+    sim._clock = now
+
+
+def run_Simulation(parameters):
+    '''
+    Runs (or resumes) one simulation of the sweep, and writes its summary into its datadir.
+    Returns the summary.
+    '''
+    name = run_name(parameters)
+    datadir = os.path.join(sweep_datadir, name)
+    summary = dict(parameters, name = name, status = "failed", walltime = 0.0, steps = 0, resumed = False)
+
+    try:
+        dumpfile = os.path.join(datadir, "frame.dmp")
+        if os.path.isfile(dumpfile):
+            # Continue an interrupted run from the last snapshot
+            sim = readdump(dumpfile)
+            summary["resumed"] = True
+        else:
+            sim = get_Simulation(**parameters)
+            sim.writer.datadir = datadir
+            sim.t.snapshots = snapshots
+            sim.writer.overwrite = True
+            sim.writer.dumping = True
+            sim._steps = 0
+            sim._walltime = 0.0
+        sim.verbosity = 0
+        sim.writer.verbosity = 0
+
+        sim.updater.diastole = count_step
+        sim._clock = time.perf_counter()
+        if sim.t < sim.t.snapshots[-1]:
+            sim.run()
+
+        summary["walltime"] = sim._walltime
+        summary["steps"] = sim._steps
+        summary["status"] = "completed"
+
+        with open(os.path.join(datadir, summary_filename), "w") as file:
+            json.dump(summary, file, indent = 4)
+
+    except Exception as error:
+        summary["status"] = "failed: {}".format(error)
+
+    return summary
+
+
+def run_Sweep(parameter_grid, processes = None):
+    '''
+    Runs every combination of the parameter grid in a pool of processes, skipping the completed runs.
+    Returns the summaries of all the runs, also written into sweep_summary.csv.
+    '''
+    keys = list(parameter_grid)
+    runs = [dict(zip(keys, values)) for values in itertools.product(*parameter_grid.values())]
+
+    summaries = {}
+    pending = []
+    for parameters in runs:
+        name = run_name(parameters)
+        filename = os.path.join(sweep_datadir, name, summary_filename)
+        if os.path.isfile(filename):
+            with open(filename) as file:
+                summaries[name] = json.load(file)
+        else:
+            pending.append(parameters)
+
+    print("Runs: {} completed, {} pending".format(len(summaries), len(pending)))
+
+    with ProcessPoolExecutor(max_workers = processes) as pool:
+        for summary in pool.map(run_Simulation, pending):
+            summaries[summary["name"]] = summary
+            print("{}: {} ({:.1f} s, {} steps)".format(summary["name"], summary["status"], summary["walltime"], summary["steps"]))
+
+    # Summary table, in the order of the parameter grid
+    summaries = [summaries[run_name(parameters)] for parameters in runs]
+    os.makedirs(sweep_datadir, exist_ok = True)
+    with open(os.path.join(sweep_datadir, "sweep_summary.csv"), "w") as file:
+        file.write(",".join(summary_columns) + "\n")
+        for summary in summaries:
+            file.write(",".join(str(summary.get(column, "")) for column in summary_columns) + "\n")
+
+    return summaries
+
+
+if __name__ == "__main__":
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    run_Sweep(parameter_grid, processes)